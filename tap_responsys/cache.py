@@ -0,0 +1,180 @@
+import hashlib
+import io
+import mmap
+import os
+import tempfile
+import time
+import singer
+from contextlib import contextmanager
+
+LOGGER = singer.get_logger()
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024 # 1 GiB
+
+# Partial downloads that haven't been written to for this long were left
+# behind by a run that was killed, and are removed during eviction
+STALE_TMP_SECONDS = 60 * 60
+
+class StagingError(Exception):
+    """ Raised when a download can't be written to the local cache directory. """
+
+@contextmanager
+def staging_errors():
+    """ Turns OSErrors from local disk operations into StagingErrors, so they aren't mistaken for SFTP errors. """
+    try:
+        yield
+    except OSError as ex:
+        raise StagingError(ex) from ex
+
+class StagingFile():
+    """ Wraps the file being staged so that local write errors can be told apart from SFTP errors. """
+    def __init__(self, file_obj):
+        self._file_obj = file_obj
+
+    def write(self, data):
+        with staging_errors():
+            return self._file_obj.write(data)
+
+class FileCache():
+    """
+    Local staging directory for exported files, keyed by the SFTP account they were downloaded
+    from and (filepath, size, last_modified).
+
+    Entries are written once and then shared by discovery, sync and any re-runs on the same
+    host. Cached files are handed out as read-only memory maps, and the least recently used
+    entries are evicted to keep the directory under `max_bytes`. The quota is best-effort:
+    downloads still in flight in other processes can take the directory over it for a while.
+    """
+    entry_suffix = '.export'
+    tmp_suffix = '.tmp'
+
+    def __init__(self, directory, max_bytes=None, identity=None):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = DEFAULT_MAX_BYTES if max_bytes is None else max_bytes
+        self.identity = identity or ()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def entry_path(self, f):
+        """ Takes a file dict {"filepath": "...", "last_modified": "...", "size": ...} and returns its location in the cache. """
+        key = '\0'.join(str(part) for part in [*self.identity, f["filepath"], f["size"], f["last_modified"].timestamp()])
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + self.entry_suffix)
+
+    def get_file_handle(self, f, fetch):
+        """
+        Returns a handle to the cached copy of `f`, calling `fetch(file_obj)` to write the
+        contents into the cache first if there is no entry for it yet.
+        """
+        path = self.entry_path(f)
+
+        # Another process may evict the entry at any point, so treat that as a miss
+        try:
+            os.utime(path) # Mark as most recently used
+            handle = open_mapped(path)
+            LOGGER.info("Reading %s from local cache.", f["filepath"])
+            return handle
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            LOGGER.warning("Could not read %s from local cache (%s), reading it into memory instead.", f["filepath"], ex)
+            return fetch_to_memory(fetch)
+
+        if f["size"] > self.max_bytes:
+            LOGGER.info("%s is larger than the local cache (%s bytes), skipping cache.", f["filepath"], self.max_bytes)
+            return fetch_to_memory(fetch)
+
+        try:
+            with staging_errors():
+                self.evict(f["size"])
+            return self.stage(f, fetch, path)
+        except StagingError as ex:
+            LOGGER.warning("Could not stage %s in local cache (%s), reading it into memory instead.", f["filepath"], ex)
+            return fetch_to_memory(fetch)
+
+    def stage(self, f, fetch, path):
+        """ Downloads `f` into the cache at `path` and returns a handle to it. """
+        # Download next to the final entry and rename it into place, so that
+        # other processes sharing the directory never see a partial file
+        with staging_errors():
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=self.tmp_suffix)
+        try:
+            with staging_errors():
+                tmp_file = os.fdopen(fd, 'wb')
+            try:
+                fetch(StagingFile(tmp_file))
+            finally:
+                with staging_errors():
+                    tmp_file.close()
+
+            with staging_errors():
+                handle = open_mapped(tmp_path)
+                if os.path.getsize(tmp_path) == f["size"]:
+                    os.replace(tmp_path, path)
+                else:
+                    LOGGER.warning("Size of %s changed while downloading, not caching it.", f["filepath"])
+                    os.remove(tmp_path)
+        except Exception:
+            try:
+                remove_if_exists(tmp_path)
+            except OSError:
+                pass
+            raise
+        return handle
+
+    def evict(self, incoming_bytes):
+        """
+        Removes stale partial downloads, then least recently used entries until
+        `incoming_bytes` more will fit under `max_bytes`.
+        """
+        entries = []
+        total_bytes = 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                file_stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            if name.endswith(self.tmp_suffix):
+                if now - file_stat.st_mtime > STALE_TMP_SECONDS:
+                    LOGGER.info("Removing stale partial download %s from local cache.", path)
+                    remove_if_exists(path)
+                else:
+                    total_bytes += file_stat.st_size
+            elif name.endswith(self.entry_suffix):
+                entries.append((file_stat.st_mtime, file_stat.st_size, path))
+                total_bytes += file_stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total_bytes + incoming_bytes <= self.max_bytes:
+                break
+            LOGGER.info("Evicting %s from local cache.", path)
+            remove_if_exists(path)
+            total_bytes -= size
+
+def fetch_to_memory(fetch):
+    buf = io.BytesIO()
+    fetch(buf)
+    buf.seek(0)
+    return buf
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def open_mapped(path):
+    """ Returns a read-only memory map of the file at `path`, which reads like a file object. """
+    with open(path, 'rb') as file_obj:
+        if os.fstat(file_obj.fileno()).st_size == 0:
+            return io.BytesIO()
+        return mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+
+def from_config(config):
+    if not config.get('local_cache_dir'):
+        return None
+    max_bytes = config.get('local_cache_max_bytes')
+    # Keep exports from different servers and accounts apart when they share a directory
+    identity = (config['host'], int(config.get('port') or 22), config['username'])
+    return FileCache(config['local_cache_dir'], None if max_bytes is None else int(max_bytes), identity)
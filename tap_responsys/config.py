@@ -10,5 +10,7 @@ CONFIG_CONTRACT = Schema({
     Required('username'): str,
     Required('path'): str,
     Required('private_key_file'): str,
-    Optional('port'): coercible_int
+    Optional('port'): coercible_int,
+    Optional('local_cache_dir'): str,
+    Optional('local_cache_max_bytes'): coercible_int
 }, extra=ALLOW_EXTRA)
@@ -10,6 +10,7 @@ import time
 from io import RawIOBase
 from datetime import datetime
 from paramiko.ssh_exception import AuthenticationException
+from tap_responsys import cache
 
 LOGGER = singer.get_logger()
 
@@ -48,7 +49,7 @@ class FileMatcher():
         return re.sub('{}$'.format(self.re_file_extension), '.ready', filepath)
 
 class SFTPConnection():
-    def __init__(self, host, username, password=None, private_key_file=None, port=None):
+    def __init__(self, host, username, password=None, private_key_file=None, port=None, file_cache=None):
         self.host = host
         self.username = username
         self.password = password
@@ -56,6 +57,7 @@ class SFTPConnection():
         self.private_key_file = private_key_file
         self.__active_connection = False
         self.regex = FileMatcher()
+        self.file_cache = file_cache
 
     def handle_backoff(details):
         LOGGER.warn("SSH Connection closed unexpectedly. Waiting {wait} seconds and retrying...".format(**details))
@@ -130,7 +132,8 @@ class SFTPConnection():
                 # NB: SFTP specifies path characters to be '/'
                 #     https://tools.ietf.org/html/draft-ietf-secsh-filexfer-13#section-6
                 files.append({"filepath": prefix + '/' + file_attr.filename,
-                              "last_modified": datetime.utcfromtimestamp(file_attr.st_mtime).replace(tzinfo=pytz.UTC)})
+                              "last_modified": datetime.utcfromtimestamp(file_attr.st_mtime).replace(tzinfo=pytz.UTC),
+                              "size": file_attr.st_size})
 
         return files
 
@@ -154,7 +157,7 @@ class SFTPConnection():
         return to_return
 
     def get_file_handle(self, f):
-        """ Takes a file dict {"filepath": "...", "last_modified": "..."} and returns a handle to the file. """
+        """ Takes a file dict {"filepath": "...", "last_modified": "...", "size": ...} and returns a handle to the file. """
         is_ready = True # False
         sleep_time = 1 # Start at 1 second, exponentially backoff
         filepath = f["filepath"]
@@ -174,12 +177,15 @@ class SFTPConnection():
                 time.sleep(sleep_time)
                 sleep_time *= 2
 
+        if self.file_cache is not None and "size" in f:
+            return self.file_cache.get_file_handle(f, lambda file_obj: self.sftp.getfo(filepath, file_obj))
+
         # Read the whole file here and return a BytesIO object
-        # NB: If CSV files become too large, read these to disk in a tmp dir and clean them up when finished
+        # NB: If CSV files become too large, set `local_cache_dir` to stage them on disk instead
         return io.BytesIO(self.sftp.open(filepath, 'r').read())
 
     def get_files_matching_pattern(self, files, pattern):
-        """ Takes a file dict {"filepath": "...", "last_modified": "..."} and a regex pattern string, and returns files matching that pattern. """
+        """ Takes a file dict {"filepath": "...", "last_modified": "...", "size": ...} and a regex pattern string, and returns files matching that pattern. """
         matcher = re.compile(pattern)
         return [f for f in files if matcher.search(f["filepath"])]
 
@@ -188,7 +194,8 @@ def connection(config):
                           config['username'],
                           password=config.get('password'),
                           private_key_file=config.get('private_key_file'),
-                          port=config.get('port'))
+                          port=config.get('port'),
+                          file_cache=cache.from_config(config))
 
 class RawStream(RawIOBase):
     """ Helper class to pass into encodings, so that Paramiko matches the types expected by base Python IO. """
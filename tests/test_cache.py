@@ -0,0 +1,254 @@
+import errno
+import io
+import os
+import stat
+import tempfile
+import time
+from datetime import datetime, timezone
+from unittest import TestCase, mock
+from tap_responsys import cache
+from tap_responsys.cache import FileCache
+from tap_responsys.sftp import SFTPConnection
+
+class NoSpaceFile(io.FileIO):
+    def write(self, data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+class TestFileCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.fetches = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_file(self, name, contents, minute=0):
+        return {"filepath": "exports/" + name,
+                "last_modified": datetime(2018, 9, 11, 9, minute, tzinfo=timezone.utc),
+                "size": len(contents),
+                "contents": contents}
+
+    def fetcher(self, f):
+        def fetch(file_obj):
+            self.fetches.append(f["filepath"])
+            file_obj.write(f["contents"])
+        return fetch
+
+    def test_cache_hit_skips_download(self):
+        file_cache = FileCache(self.tmp_dir.name)
+        f = self.make_file("table.csv", b"id\n1\n")
+
+        first = file_cache.get_file_handle(f, self.fetcher(f))
+        second = file_cache.get_file_handle(f, self.fetcher(f))
+
+        self.assertEqual(b"id\n1\n", first.read())
+        self.assertEqual(b"id\n1\n", second.read())
+        self.assertEqual(["exports/table.csv"], self.fetches)
+
+    def test_modified_file_is_downloaded_again(self):
+        file_cache = FileCache(self.tmp_dir.name)
+        f = self.make_file("table.csv", b"id\n1\n")
+        modified = self.make_file("table.csv", b"id\n2\n", minute=1)
+
+        file_cache.get_file_handle(f, self.fetcher(f))
+        handle = file_cache.get_file_handle(modified, self.fetcher(modified))
+
+        self.assertEqual(b"id\n2\n", handle.read())
+        self.assertEqual(2, len(self.fetches))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        file_cache = FileCache(self.tmp_dir.name, max_bytes=8)
+        first = self.make_file("first.csv", b"id\n1\n")
+        second = self.make_file("second.csv", b"id\n2\n")
+
+        file_cache.get_file_handle(first, self.fetcher(first))
+        os.utime(file_cache.entry_path(first), (0, 0))
+        file_cache.get_file_handle(second, self.fetcher(second))
+        file_cache.get_file_handle(second, self.fetcher(second))
+        file_cache.get_file_handle(first, self.fetcher(first))
+
+        self.assertEqual(["exports/first.csv", "exports/second.csv", "exports/first.csv"], self.fetches)
+        self.assertTrue(os.path.exists(file_cache.entry_path(first)))
+        self.assertFalse(os.path.exists(file_cache.entry_path(second)))
+
+    def test_file_larger_than_quota_is_not_cached(self):
+        file_cache = FileCache(self.tmp_dir.name, max_bytes=2)
+        f = self.make_file("table.csv", b"id\n1\n")
+
+        handle = file_cache.get_file_handle(f, self.fetcher(f))
+
+        self.assertEqual(b"id\n1\n", handle.read())
+        self.assertFalse(os.path.exists(file_cache.entry_path(f)))
+
+    def test_entry_evicted_by_another_process_is_downloaded_again(self):
+        file_cache = FileCache(self.tmp_dir.name)
+        f = self.make_file("table.csv", b"id\n1\n")
+        file_cache.get_file_handle(f, self.fetcher(f))
+
+        real_utime = os.utime
+        def evict_then_utime(path, *args, **kwargs):
+            os.remove(path)
+            return real_utime(path, *args, **kwargs)
+
+        with mock.patch('tap_responsys.cache.os.utime', side_effect=evict_then_utime):
+            handle = file_cache.get_file_handle(f, self.fetcher(f))
+
+        self.assertEqual(b"id\n1\n", handle.read())
+        self.assertEqual(2, len(self.fetches))
+
+    def test_stale_partial_downloads_are_removed(self):
+        file_cache = FileCache(self.tmp_dir.name, max_bytes=8)
+        stale_path = os.path.join(self.tmp_dir.name, "stale.tmp")
+        fresh_path = os.path.join(self.tmp_dir.name, "fresh.tmp")
+        for path in (stale_path, fresh_path):
+            with open(path, 'wb') as tmp_file:
+                tmp_file.write(b"id\n")
+        stale_time = time.time() - cache.STALE_TMP_SECONDS - 1
+        os.utime(stale_path, (stale_time, stale_time))
+        f = self.make_file("table.csv", b"id\n1\n")
+
+        file_cache.get_file_handle(f, self.fetcher(f))
+
+        self.assertFalse(os.path.exists(stale_path))
+        self.assertTrue(os.path.exists(fresh_path))
+        self.assertTrue(os.path.exists(file_cache.entry_path(f)))
+
+    def test_partial_downloads_count_toward_quota(self):
+        file_cache = FileCache(self.tmp_dir.name, max_bytes=8)
+        with open(os.path.join(self.tmp_dir.name, "in_flight.tmp"), 'wb') as tmp_file:
+            tmp_file.write(b"id\n")
+        first = self.make_file("first.csv", b"id\n1\n")
+        second = self.make_file("second.csv", b"id\n2\n")
+
+        file_cache.get_file_handle(first, self.fetcher(first))
+        file_cache.evict(0)
+
+        self.assertTrue(os.path.exists(file_cache.entry_path(first)))
+        file_cache.get_file_handle(second, self.fetcher(second))
+        self.assertFalse(os.path.exists(file_cache.entry_path(first)))
+
+    def test_local_disk_error_falls_back_to_memory(self):
+        file_cache = FileCache(self.tmp_dir.name)
+        f = self.make_file("table.csv", b"id\n1\n")
+
+        with mock.patch('tap_responsys.cache.tempfile.mkstemp', side_effect=OSError(errno.ENOSPC, "No space left on device")):
+            handle = file_cache.get_file_handle(f, self.fetcher(f))
+
+        self.assertEqual(b"id\n1\n", handle.read())
+        self.assertFalse(os.path.exists(file_cache.entry_path(f)))
+
+    def test_local_write_error_falls_back_to_memory(self):
+        file_cache = FileCache(self.tmp_dir.name)
+        f = self.make_file("table.csv", b"id\n1\n")
+
+        with mock.patch('tap_responsys.cache.os.fdopen', side_effect=NoSpaceFile):
+            handle = file_cache.get_file_handle(f, self.fetcher(f))
+
+        self.assertEqual(b"id\n1\n", handle.read())
+        self.assertEqual(2, len(self.fetches))
+        self.assertEqual([], os.listdir(self.tmp_dir.name))
+
+    def test_unreadable_entry_falls_back_to_memory(self):
+        file_cache = FileCache(self.tmp_dir.name)
+        f = self.make_file("table.csv", b"id\n1\n")
+        file_cache.get_file_handle(f, self.fetcher(f))
+
+        with mock.patch('tap_responsys.cache.os.utime', side_effect=PermissionError(errno.EPERM, "Operation not permitted")):
+            handle = file_cache.get_file_handle(f, self.fetcher(f))
+
+        self.assertEqual(b"id\n1\n", handle.read())
+        self.assertEqual(2, len(self.fetches))
+
+    def test_entries_are_kept_apart_per_identity(self):
+        first_account = FileCache(self.tmp_dir.name, identity=("files.responsys.net", 22, "first"))
+        second_account = FileCache(self.tmp_dir.name, identity=("files.responsys.net", 22, "second"))
+        first = self.make_file("table.csv", b"id\n1\n")
+        second = self.make_file("table.csv", b"id\n2\n")
+
+        self.assertNotEqual(first_account.entry_path(first), second_account.entry_path(second))
+
+        first_account.get_file_handle(first, self.fetcher(first))
+        handle = second_account.get_file_handle(second, self.fetcher(second))
+
+        self.assertEqual(b"id\n2\n", handle.read())
+        self.assertEqual(2, len(self.fetches))
+
+    def test_download_error_is_raised(self):
+        file_cache = FileCache(self.tmp_dir.name)
+        f = self.make_file("table.csv", b"id\n1\n")
+
+        def fetch(file_obj):
+            raise IOError("Connection lost")
+
+        with self.assertRaises(IOError):
+            file_cache.get_file_handle(f, fetch)
+        self.assertEqual([], os.listdir(self.tmp_dir.name))
+
+    def test_from_config(self):
+        self.assertIsNone(cache.from_config({}))
+
+        config = {"host": "files.responsys.net", "username": "test_scp", "local_cache_dir": self.tmp_dir.name}
+
+        file_cache = cache.from_config({**config, "local_cache_max_bytes": "100", "port": "2222"})
+        self.assertEqual(self.tmp_dir.name, file_cache.directory)
+        self.assertEqual(100, file_cache.max_bytes)
+        self.assertEqual(("files.responsys.net", 2222, "test_scp"), file_cache.identity)
+
+        file_cache = cache.from_config(config)
+        self.assertEqual(cache.DEFAULT_MAX_BYTES, file_cache.max_bytes)
+        self.assertEqual(("files.responsys.net", 22, "test_scp"), file_cache.identity)
+
+class TestSFTPConnectionCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_connection(self, file_cache):
+        conn = SFTPConnection("host", "username", file_cache=file_cache)
+        # Mark the connection as already open, so the mocked `sftp` is used
+        # instead of connecting to the host
+        conn._SFTPConnection__active_connection = True
+        conn.transport = mock.Mock()
+        conn.sftp = mock.Mock()
+        conn.sftp.getfo.side_effect = lambda filepath, file_obj: file_obj.write(b"id\n1\n")
+        conn.sftp.open.return_value.read.return_value = b"id\n1\n"
+        return conn
+
+    def test_get_files_by_prefix_includes_size(self):
+        conn = self.make_connection(None)
+        file_attr = mock.Mock(filename="table.csv", st_size=5, st_mode=stat.S_IFREG, st_mtime=1536656400)
+        conn.sftp.listdir_attr.return_value = [file_attr]
+
+        files = conn.get_files_by_prefix("exports")
+
+        self.assertEqual([{"filepath": "exports/table.csv",
+                           "last_modified": datetime(2018, 9, 11, 9, 0, tzinfo=timezone.utc),
+                           "size": 5}], files)
+
+    def test_get_file_handle_downloads_once(self):
+        conn = self.make_connection(FileCache(self.tmp_dir.name))
+        f = {"filepath": "exports/table.csv",
+             "last_modified": datetime(2018, 9, 11, 9, 0, tzinfo=timezone.utc),
+             "size": 5}
+
+        first = conn.get_file_handle(f)
+        second = conn.get_file_handle(f)
+
+        self.assertEqual(b"id\n1\n", first.read())
+        self.assertEqual(b"id\n1\n", second.read())
+        self.assertEqual(1, conn.sftp.getfo.call_count)
+        conn.sftp.open.assert_not_called()
+
+    def test_get_file_handle_without_cache(self):
+        f = {"filepath": "exports/table.csv",
+             "last_modified": datetime(2018, 9, 11, 9, 0, tzinfo=timezone.utc),
+             "size": 5}
+        file_without_size = {"filepath": f["filepath"], "last_modified": f["last_modified"]}
+        for conn, file_dict in ((self.make_connection(None), f),
+                                (self.make_connection(FileCache(self.tmp_dir.name)), file_without_size)):
+            handle = conn.get_file_handle(file_dict)
+
+            self.assertEqual(b"id\n1\n", handle.read())
+            conn.sftp.getfo.assert_not_called()